@@ -21,24 +21,57 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import asyncio
+import atexit
 import collections
+import functools
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import diskcache
+except ImportError:  # only needed for a persistent order cache
+    diskcache = None
 
 from backtrader import BrokerBase, OrderBase, Order
 from backtrader.position import Position
-from backtrader.utils.py3 import queue, with_metaclass
+from backtrader.utils.py3 import with_metaclass
 
 from .ccxtstore import CCXTStore
 
 
+@functools.lru_cache(maxsize=256)
+def _method_name(type_, endpoint):
+    '''Build the ccxt implicit method name for a private end point,
+    e.g. ('Post', 'order/{id}/cancel') -> 'private_postorder_id_cancel'.
+    '''
+    endpoint_str = endpoint.replace('/', '_').replace('{', '').replace('}', '')
+    return 'private_' + type_.lower() + endpoint_str.lower()
+
+
+def _stop_market_args(price, params):
+    # Keep a stopPrice the caller passed explicitly
+    params.setdefault('stopPrice', price)
+    return price, params
+
+
+def _market_args(price, params):
+    # Binance doesn't want price for market orders
+    return None, params
+
+
 class CCXTOrder(OrderBase):
     def __init__(self, owner, data, ccxt_order):
         self.owner = owner
         self.data = data
         self.ccxt_order = ccxt_order
-        self.executed_fills = []
+        self.executed_fills = set()  # ids of fills already executed
         self.ordtype = self.Buy if ccxt_order['side'] == 'buy' else self.Sell
-        self.size = float(ccxt_order['amount'])
+        # ccxt already parses amounts to float
+        amount = ccxt_order['amount']
+        self.size = amount if isinstance(amount, float) else float(amount)
 
         super(CCXTOrder, self).__init__()
 
@@ -93,8 +126,42 @@ class CCXTBroker(with_metaclass(MetaCCXTBroker, BrokerBase)):
 
     Added new private_end_point method to allow using any private non-unified end point
 
+    Open orders are polled at most once every ``poll_interval`` seconds
+    (default ``DEFAULT_POLL_INTERVAL``) rather than on every call to next(),
+    which backtrader makes continuously while waiting on live data.
+
+    Order status requests are issued on a pool of ``fetch_workers`` threads
+    (default ``DEFAULT_FETCH_WORKERS``). All workers share the store's sync
+    ccxt instance, whose rate limiter isn't thread safe, and concurrent signed
+    requests can reuse or reorder nonces (e.g. a millisecond time based
+    nonce), which exchanges like Kraken reject. Only raise it above 1 for
+    exchanges that tolerate concurrent private requests.
+
+    Orders fetched in a final state (closed, canceled, ...) are cached until
+    they stop being tracked, so they are never requested again. Pass ``order_cache_dir`` to keep that cache on
+    disk across restarts (requires the ``diskcache`` package).
+
+    With ``use_websockets=True`` order updates are also pushed by ccxt.pro
+    ``watch_orders`` as they happen. Open orders are still polled every
+    ``poll_interval`` to pick up anything the websocket missed, e.g. before
+    the subscription was live, or if ccxt.pro or the exchange doesn't support
+    it, or the connection drops.
+
+    Submitted orders are built from the ``create_order`` response. Set
+    ``fetch_after_create=True`` to always fetch the order again instead.
+
     '''
 
+    DEFAULT_POLL_INTERVAL = 30  # seconds between open order status checks
+    DEFAULT_FETCH_WORKERS = 1  # max concurrent order status requests
+
+    # ccxt order statuses after which an order will never change again
+    _FINAL_STATUSES = ('closed', 'canceled', 'expired', 'rejected')
+
+    # Order types needing (price, params) adjusted before submission
+    _submit_args = {'STOP_MARKET': _stop_market_args,
+                    'market': _market_args}
+
     order_types = {Order.Market: 'market',
                    Order.Limit: 'limit',
                    Order.Stop: 'stop',  # stop-loss for kraken, stop for bitmex
@@ -110,7 +177,9 @@ class CCXTBroker(with_metaclass(MetaCCXTBroker, BrokerBase)):
             'value': 'canceled'}
     }
 
-    def __init__(self, broker_mapping=None, debug=False, **kwargs):
+    def __init__(self, broker_mapping=None, debug=False, poll_interval=DEFAULT_POLL_INTERVAL,
+                 fetch_workers=DEFAULT_FETCH_WORKERS, order_cache_dir=None,
+                 use_websockets=False, fetch_after_create=False, **kwargs):
         super(CCXTBroker, self).__init__()
 
         if broker_mapping is not None:
@@ -123,22 +192,70 @@ class CCXTBroker(with_metaclass(MetaCCXTBroker, BrokerBase)):
             except KeyError:  # might not want to change the mappings
                 pass
 
+        # Resolved once, these are checked for every polled order
+        self._closed_key = self.mappings['closed_order']['key']
+        self._closed_val = self.mappings['closed_order']['value']
+        self._canceled_val = self.mappings['canceled_order']['value']
+
         self.store = CCXTStore(**kwargs)
 
         self.currency = self.store.currency
 
         self.positions = collections.defaultdict(Position)
 
-        self.debug = True
+        self.debug = debug
         self.indent = 4  # For pretty printing dictionaries
 
-        self.notifs = queue.Queue()  # holds orders which are notified
-
-        self.open_orders = list()
+        self.notifs = collections.deque()  # holds orders which are notified
+
+        self.open_orders = dict()  # open CCXTOrders keyed by ccxt order id
+
+        self.fetch_after_create = fetch_after_create
+        self.poll_interval = poll_interval
+        self._last_poll = None  # monotonic time of the last open order poll
+        self._balance_dirty = False  # refresh the balance after the current batch
+
+        self._fetch_pool = ThreadPoolExecutor(max_workers=fetch_workers,
+                                              thread_name_prefix='ccxt-fetch')
+        atexit.register(self._fetch_pool.shutdown)
+
+        if order_cache_dir is None:
+            self._order_cache = dict()
+        elif diskcache is None:
+            raise ImportError('order_cache_dir requires the diskcache package')
+        else:
+            self._order_cache = diskcache.Cache(order_cache_dir)
+        # The cache may be shared across runs, key it by venue as well so
+        # another exchange or testnet/live can't return a matching order id.
+        # Testnets are selected with set_sandbox_mode or by overriding urls
+        exchange = self.store.exchange
+        self._order_cache_ns = (exchange.id, self.store._sandbox, repr(exchange.urls.get('api')))
+
+        self.use_websockets = use_websockets
+        self._ws_updates = collections.deque()  # ccxt orders pushed by watch_orders
+        self._ws_active = False  # True once watch_orders has delivered updates
+        self._ws_loop = None
+        self._ws_task = None
 
         self.startingcash = self.store._cash
         self.startingvalue = self.store._value
 
+    def start(self):
+        super(CCXTBroker, self).start()
+        if self.use_websockets:
+            threading.Thread(target=asyncio.run, args=(self._watch_orders(),),
+                             name='ccxt-watch-orders', daemon=True).start()
+
+    def stop(self):
+        super(CCXTBroker, self).stop()
+        # The watcher thread clears _ws_task when it exits, bind it first
+        ws_task = self._ws_task
+        if ws_task is not None:
+            try:
+                self._ws_loop.call_soon_threadsafe(ws_task.cancel)
+            except RuntimeError:  # loop already closed
+                pass
+
     def get_balance(self):
         self.store.get_balance()
         self.cash = self.store._cash
@@ -171,12 +288,12 @@ class CCXTBroker(with_metaclass(MetaCCXTBroker, BrokerBase)):
 
     def get_notification(self):
         try:
-            return self.notifs.get(False)
-        except queue.Empty:
+            return self.notifs.popleft()
+        except IndexError:
             return None
 
     def notify(self, order):
-        self.notifs.put(order)
+        self.notifs.append(order)
 
     def getposition(self, data, clone=True):
         # return self.o.getposition(data._dataname, clone=clone)
@@ -185,75 +302,178 @@ class CCXTBroker(with_metaclass(MetaCCXTBroker, BrokerBase)):
             pos = pos.clone()
         return pos
 
+    def _seconds_until_next_poll(self):
+        if self._last_poll is None:
+            return 0
+        return max(0, self._last_poll + self.poll_interval - time.monotonic())
+
     def next(self):
         if self.debug:
             print('Broker next() called')
-        
-        for o_order in list(self.open_orders):
-            oID = o_order.ccxt_order['id']
 
-            # Print debug before fetching so we know which order is giving an
-            # issue if it crashes
+        if self._ws_active or self._ws_updates:
+            for o_order, ccxt_order in self._pop_watched_orders():
+                self._apply_update(o_order, ccxt_order)
+
+        # Polled even while watching orders, to reconcile missed pushes
+        if self.open_orders and self._seconds_until_next_poll() <= 0:
+            self._last_poll = time.monotonic()
+            for o_order, ccxt_order in self._poll_open_orders():
+                self._apply_update(o_order, ccxt_order)
+
+        # One balance request for the whole batch rather than one per order
+        if self._balance_dirty:
+            self._balance_dirty = False
+            self.get_balance()
+
+    def _poll_open_orders(self):
+        '''Returns (CCXTOrder, ccxt order) pairs for all open orders'''
+        # Fetch on the pool, the updates are applied in the main thread
+        orders = list(self.open_orders.items())
+        fetched = dict()  # ccxt order id -> latest ccxt order
+
+        if self.store.exchange.has.get('fetchOpenOrders'):
+            # One request per symbol rather than one per open order
+            symbols = set(o_order.data.p.dataname for _, o_order in orders)
+            for ccxt_orders in self._fetch_pool.map(self.store.fetch_open_orders, symbols):
+                fetched.update((ccxt_order['id'], ccxt_order) for ccxt_order in ccxt_orders)
+
+        # Orders missing from the open orders have been closed or canceled
+        # since the last poll, fetch those individually
+        missing = [o_order for oID, o_order in orders if oID not in fetched]
+        for o_order, ccxt_order in zip(missing, self._fetch_pool.map(self._fetch_order, missing)):
+            fetched[o_order.ccxt_order['id']] = ccxt_order
+
+        return [(o_order, fetched[oID]) for oID, o_order in orders]
+
+    def _pop_watched_orders(self):
+        '''Returns (CCXTOrder, ccxt order) pairs for the updates pushed by
+        watch_orders since the last call, skipping orders not opened here'''
+        updates = []
+        while self._ws_updates:
+            ccxt_order = self._ws_updates.popleft()
+            o_order = self.open_orders.get(ccxt_order['id'])
+            if o_order is not None:
+                updates.append((o_order, ccxt_order))
+        return updates
+
+    async def _watch_orders(self):
+        exchange = self.store.get_pro_exchange()
+        if exchange is None or not exchange.has.get('watchOrders'):
+            if exchange is not None:
+                await exchange.close()
             if self.debug:
-                print('Fetching Order ID: {}'.format(oID))
-
-            # Get the order
-            ccxt_order = self.store.fetch_order(oID, o_order.data.p.dataname)
-            print('ccxt_order', ccxt_order)
-            # Check for new fills
-            if 'trades' in ccxt_order and ccxt_order['trades']!=None:
-                for fill in ccxt_order['trades']:
-                    if fill not in o_order.executed_fills:
-                        o_order.execute(fill['datetime'], fill['amount'], fill['price'], 
-                                        0, 0.0, 0.0, 
-                                        0, 0.0, 0.0, 
-                                        0.0, 0.0,
-                                        0, 0.0)
-                        o_order.executed_fills.append(fill['id'])
+                print('watch_orders not available, polling open orders instead')
+            return
 
+        self._ws_loop = asyncio.get_running_loop()
+        self._ws_task = asyncio.current_task()
+        try:
+            while True:
+                ccxt_orders = await exchange.watch_orders()
+                if not self._ws_active:
+                    # Subscription is live, catch up on anything missed before
+                    self._ws_active = True
+                    self._last_poll = None
+                self._ws_updates.extend(ccxt_orders)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:  # Connection lost, polling carries on alone
             if self.debug:
-                print(json.dumps(ccxt_order, indent=self.indent))
+                print('watch_orders stopped, polling open orders instead: {}'.format(e))
+        finally:
+            self._ws_active = False
+            self._ws_task = None
+            await exchange.close()
+
+    def _apply_update(self, o_order, ccxt_order):
+        '''Execute any new fills of ``o_order`` and complete it if
+        ``ccxt_order`` reports it closed'''
+        # Check for new fills
+        if 'trades' in ccxt_order and ccxt_order['trades']!=None:
+            for fill in ccxt_order['trades']:
+                fid = fill['id']
+                if fid not in o_order.executed_fills:
+                    o_order.execute(fill['datetime'], fill['amount'], fill['price'], 
+                                    0, 0.0, 0.0, 
+                                    0, 0.0, 0.0, 
+                                    0.0, 0.0,
+                                    0, 0.0)
+                    o_order.executed_fills.add(fid)
+
+        if self.debug:
+            print(json.dumps(ccxt_order, indent=self.indent))
+
+        # Check if the order is closed
+        if ccxt_order[self._closed_key] == self._closed_val:
+            pos = self.getposition(o_order.data, clone=False)
+            pos.update(o_order.size, o_order.price)
+            o_order.completed()
+            self.notify(o_order)
+            self._drop_open_order(o_order)
+            self._balance_dirty = True
+
+    def _drop_open_order(self, o_order):
+        '''Stop tracking ``o_order``, its cached final state won't be read again'''
+        self.open_orders.pop(o_order.ccxt_order['id'], None)
+        self._order_cache.pop(self._order_cache_key(o_order), None)
 
-            # Check if the order is closed
-            if ccxt_order[self.mappings['closed_order']['key']] == self.mappings['closed_order']['value']:
-                pos = self.getposition(o_order.data, clone=False)
-                pos.update(o_order.size, o_order.price)
-                o_order.completed()
-                self.notify(o_order)
-                self.open_orders.remove(o_order)
-                self.get_balance()
+    def _order_cache_key(self, o_order):
+        return self._order_cache_ns + (o_order.ccxt_order['id'], o_order.data.p.dataname)
+
+    def _fetch_order(self, o_order):
+        oID = o_order.ccxt_order['id']
+
+        # Print debug before fetching so we know which order is giving an
+        # issue if it crashes
+        if self.debug:
+            print('Fetching Order ID: {}'.format(oID))
+
+        ck = self._order_cache_key(o_order)
+        ccxt_order = self._order_cache.get(ck)
+        if ccxt_order is not None:
+            return ccxt_order
+
+        ccxt_order = self.store.fetch_order(oID, o_order.data.p.dataname)
+        if ccxt_order.get('status') in self._FINAL_STATUSES:
+            self._order_cache[ck] = ccxt_order
+        return ccxt_order
 
     def _submit(self, owner, data, execType, side, amount, price, params):
 
         order_type = self.order_types.get(execType) if execType else 'market'
-        created = int(data.datetime.datetime(0).timestamp()*1000)
         # Extract CCXT specific params if passed to the order
-        params = params['params'] if 'params' in params else params
-        if order_type == 'STOP_MARKET':
-            params['stopPrice'] = price
-        # Binance doesn't want price for market orders
-        if order_type == 'market':
-            price = None
-        print('amount')
-        print(amount)
-        print('price')
-        print(price)
-        print('order_type')
-        print(order_type)
-        print('side')
-        print(side)
-        print('params')
-        print(params)
-        # params['created'] = created  # Add timestamp of order creation for backtesting
-
-        ret_ord = self.store.create_order(symbol=data.p.dataname, order_type=order_type, side=side,
+        params = params.get('params', params)
+        submit_args = self._submit_args.get(order_type)
+        if submit_args is not None:
+            price, params = submit_args(price, params)
+        if self.debug:
+            print('amount')
+            print(amount)
+            print('price')
+            print(price)
+            print('order_type')
+            print(order_type)
+            print('side')
+            print(side)
+            print('params')
+            print(params)
+
+        symbol = data.p.dataname
+        ret_ord = self.store.create_order(symbol=symbol, order_type=order_type, side=side,
                                           amount=amount, price=price, params=params)
 
-        _order = self.store.fetch_order(ret_ord['id'], data.p.dataname)
+        # create_order already returns the order, only fetch it again if the
+        # exchange's response is missing fields we need
+        if self.fetch_after_create or None in (ret_ord.get('status'), ret_ord.get('side'),
+                                                ret_ord.get('amount')):
+            _order = self.store.fetch_order(ret_ord['id'], symbol)
+        else:
+            _order = ret_ord
 
         order = CCXTOrder(owner, data, _order)
         order.price = ret_ord['price']
-        self.open_orders.append(order)
+        self.open_orders[order.ccxt_order['id']] = order
 
         self.notify(order)
         return order
@@ -277,14 +497,14 @@ class CCXTBroker(with_metaclass(MetaCCXTBroker, BrokerBase)):
     def cancel(self, order):
 
         oID = order.ccxt_order['id']
+        symbol = order.data.p.dataname
 
         if self.debug:
             print('Broker cancel() called')
-            print('Fetching Order ID: {}'.format(oID))
 
         # check first if the order has already been filled otherwise an error
         # might be raised if we try to cancel an order that is not open.
-        ccxt_order = self.store.fetch_order(oID, order.data.p.dataname)
+        ccxt_order = self._fetch_order(order)
 
         if self.debug:
             print(json.dumps(ccxt_order, indent=self.indent))
@@ -295,10 +515,10 @@ class CCXTBroker(with_metaclass(MetaCCXTBroker, BrokerBase)):
             # print('closed_order')
             # print(ccxt_order[self.mappings['closed_order']])
 
-        if ccxt_order[self.mappings['closed_order']['key']] == self.mappings['closed_order']['value']:
+        if ccxt_order[self._closed_key] == self._closed_val:
             return order
 
-        ccxt_order = self.store.cancel_order(oID, order.data.p.dataname)
+        ccxt_order = self.store.cancel_order(oID, symbol)
 
         if self.debug:
             print(json.dumps(ccxt_order, indent=self.indent))
@@ -310,10 +530,10 @@ class CCXTBroker(with_metaclass(MetaCCXTBroker, BrokerBase)):
             # print(ccxt_order[self.mappings['canceled_order']['value']])
             # Commenting things that are breaking the code but the order is still cancelled.
             # print('Value Received: {}'.format(ccxt_order[self.mappings['canceled_order']['key']]))
-            print('Value Expected: {}'.format(self.mappings['canceled_order']['value']))
+            print('Value Expected: {}'.format(self._canceled_val))
 
         # if ccxt_order[self.mappings['canceled_order']['key']] == self.mappings['canceled_order']['value']:
-        self.open_orders.remove(order)
+        self._drop_open_order(order)
         order.cancel()
         self.notify(order)
         return order
@@ -338,10 +558,6 @@ class CCXTBroker(with_metaclass(MetaCCXTBroker, BrokerBase)):
 
         print(dir(ccxt.hitbtc()))
         '''
-        endpoint_str = endpoint.replace('/', '_')
-        endpoint_str = endpoint_str.replace('{', '')
-        endpoint_str = endpoint_str.replace('}', '')
-
-        method_str = 'private_' + type.lower() + endpoint_str.lower()
+        method_str = _method_name(type, endpoint)
 
         return self.store.private_end_point(type=type, endpoint=method_str, params=params)
@@ -98,6 +98,8 @@ class CCXTStore(with_metaclass(MetaSingleton, object)):
     def __init__(self, exchange, currency, config, retries, debug=False, sandbox=False):
         self.exchange = getattr(ccxt, exchange)(config)
         self.exchange = getattr(ccxt, exchange)(config)
+        self._config = config
+        self._sandbox = sandbox
         if sandbox:
             self.exchange.set_sandbox_mode(True)
         self.currency = currency
@@ -147,6 +149,24 @@ class CCXTStore(with_metaclass(MetaSingleton, object)):
 
         return retry_method
 
+    def get_pro_exchange(self):
+        '''Returns a new ccxt.pro (websocket) instance of the exchange, or
+        None if the installed ccxt or the exchange don't provide one.
+
+        Must be created and used from within a running asyncio event loop.
+        '''
+        try:
+            import ccxt.pro as ccxtpro
+        except ImportError:
+            return None
+        exchange_cls = getattr(ccxtpro, self.exchange.id, None)
+        if exchange_cls is None:
+            return None
+        exchange = exchange_cls(self._config)
+        if self._sandbox:
+            exchange.set_sandbox_mode(True)
+        return exchange
+
     @retry
     def get_wallet_balance(self, currency, params=None):
         balance = self.exchange.fetch_balance(params)
@@ -192,8 +212,8 @@ class CCXTStore(with_metaclass(MetaSingleton, object)):
         return self.exchange.fetch_order(oid, symbol)
 
     @retry
-    def fetch_open_orders(self):
-        return self.exchange.fetchOpenOrders()
+    def fetch_open_orders(self, symbol=None):
+        return self.exchange.fetchOpenOrders(symbol)
 
     @retry
     def private_end_point(self, type, endpoint, params):
@@ -0,0 +1,234 @@
+import unittest
+from datetime import datetime, time
+from unittest.mock import MagicMock, patch
+
+from backtrader import Order
+
+import ccxtbt.ccxtbroker
+from ccxtbt import CCXTBroker
+
+SYMBOL = 'BTC/USDT'
+
+
+class TestBrokerOrderUpdates(unittest.TestCase):
+    """
+    Order bookkeeping of the CCXTBroker against a fake CCXTStore, so no exchange or api keys are needed.
+    The fake exchange keeps its orders in self.orders, keyed by id, which tests edit to simulate fills.
+    """
+
+    def setUp(self):
+        self.orders = {}
+        self.store = MagicMock()
+        self.store._cash = 0
+        self.store._value = 0
+        self.store._sandbox = False
+        self.store.exchange.id = 'fake'
+        self.store.exchange.urls = {'api': 'https://fake'}
+        self.store.exchange.has = {'fetchOpenOrders': True}
+        self.store.create_order.side_effect = self.create_order
+        self.store.fetch_order.side_effect = lambda oid, symbol: dict(self.orders[oid])
+        self.store.fetch_open_orders.side_effect = lambda symbol=None: [
+            dict(o) for o in self.orders.values() if o['status'] == 'open']
+
+        with patch.object(ccxtbt.ccxtbroker, 'CCXTStore', return_value=self.store):
+            self.broker = CCXTBroker(broker_mapping={'order_types': {Order.Market: 'market',
+                                                                     Order.Limit: 'limit',
+                                                                     Order.Stop: 'STOP_MARKET'}})
+
+        self.data = MagicMock()
+        self.data._dataname = SYMBOL
+        self.data.p.dataname = SYMBOL
+        self.data.p.sessionend = time(23, 59)
+        self.data.datetime.datetime.return_value = datetime(2019, 1, 1)
+        self.data.date2num.return_value = 737060.0
+
+    def create_order(self, symbol, order_type, side, amount, price, params):
+        oid = str(len(self.orders))
+        self.orders[oid] = {'id': oid, 'symbol': symbol, 'side': side, 'amount': float(amount),
+                            'price': price or 1.0, 'status': 'open', 'trades': []}
+        return dict(self.orders[oid])
+
+    def buy(self, size=1, price=10.0, execType=Order.Limit, **kwargs):
+        return self.broker.buy(None, self.data, size, price=price, execType=execType,
+                               parent=None, transmit=True, **kwargs)
+
+    def poll(self):
+        self.broker._last_poll = None  # don't wait for poll_interval
+        self.broker.next()
+
+    def test_next_polls_once_per_interval(self):
+        """
+        Backtrader calls next() continuously while waiting on live data, open orders are only polled
+        once every poll_interval.
+        """
+        self.buy()
+
+        self.broker.next()
+        self.broker.next()
+
+        self.store.fetch_open_orders.assert_called_once_with(SYMBOL)
+        self.store.fetch_order.assert_not_called()
+
+    def test_next_polls_again_after_interval(self):
+        """
+        Once poll_interval has elapsed since the last poll the open orders are polled again.
+        """
+        self.buy()
+
+        self.broker.next()
+        self.broker._last_poll -= self.broker.poll_interval + 1
+        self.broker.next()
+
+        self.assertEqual(self.store.fetch_open_orders.call_count, 2)
+
+    def test_repeated_fill_executed_once(self):
+        """
+        Exchanges keep returning the fills of an open order on every poll, each must be executed only once.
+        """
+        order = self.buy(size=2)
+        self.orders['0']['trades'] = [{'id': 'fill-1', 'datetime': 0, 'amount': 1.0, 'price': 10.0}]
+
+        self.poll()
+        self.poll()
+
+        self.assertEqual(order.executed.size, 1.0)
+
+    def test_missing_open_order_fetched_individually(self):
+        """
+        Orders no longer returned by fetch_open_orders have been closed or canceled since the last poll,
+        those are fetched one by one and a single balance refresh follows the batch.
+        """
+        order = self.buy()
+        self.orders['0']['status'] = 'closed'
+
+        self.poll()
+
+        self.store.fetch_open_orders.assert_called_once_with(SYMBOL)
+        self.store.fetch_order.assert_called_once_with('0', SYMBOL)
+        self.assertEqual(order.status, Order.Completed)
+        self.assertNotIn('0', self.broker.open_orders)
+        self.store.get_balance.assert_called_once()
+
+    def test_only_final_orders_cached(self):
+        """
+        An open order can still change and must be fetched again, a closed one is served from the cache.
+        """
+        order = self.buy()
+
+        self.broker._fetch_order(order)
+        self.broker._fetch_order(order)
+        self.assertEqual(self.store.fetch_order.call_count, 2)
+
+        self.orders['0']['status'] = 'closed'
+        self.broker._fetch_order(order)
+        self.assertEqual(self.broker._fetch_order(order)['status'], 'closed')
+        self.assertEqual(self.store.fetch_order.call_count, 3)
+
+    def test_cache_does_not_grow_with_completed_orders(self):
+        """
+        Cached final states are dropped once the order stops being tracked, including one cached by
+        cancel() finding the order already closed.
+        """
+        for _ in range(5):
+            self.buy()
+            self.orders[str(len(self.orders) - 1)]['status'] = 'closed'
+            self.poll()
+
+        order = self.buy()
+        self.orders['5']['status'] = 'closed'
+        self.broker.cancel(order)
+        self.assertEqual(len(self.broker._order_cache), 1)
+
+        self.poll()
+
+        self.assertEqual(order.status, Order.Completed)
+        self.assertEqual(len(self.broker.open_orders), 0)
+        self.assertEqual(len(self.broker._order_cache), 0)
+
+    def test_getposition_reclones_after_update(self):
+        """
+        Each clone is private to its caller and reflects updates made through clone=False.
+        """
+        before = self.broker.getposition(self.data)
+        self.assertIsNot(before, self.broker.getposition(self.data))
+
+        self.broker.getposition(self.data, clone=False).update(1.0, 10.0)
+        after = self.broker.getposition(self.data)
+
+        self.assertEqual(before.size, 0)
+        self.assertEqual(after.size, 1.0)
+        self.assertEqual(after.price, 10.0)
+
+    def test_pushed_order_updates_applied(self):
+        """
+        Orders pushed by watch_orders are applied on next() without waiting for a poll.
+        """
+        order = self.buy()
+        self.broker._ws_active = True
+        self.broker._last_poll = float('inf')  # no poll due
+        self.broker._ws_updates.append(dict(self.orders['0'], status='closed'))
+
+        self.broker.next()
+
+        self.assertEqual(order.status, Order.Completed)
+        self.store.fetch_open_orders.assert_not_called()
+
+    def test_polls_once_websocket_inactive(self):
+        """
+        When the watch_orders connection is gone next() keeps the orders up to date by polling.
+        """
+        order = self.buy()
+        self.broker._ws_active = False
+        self.orders['0']['status'] = 'closed'
+
+        self.poll()
+
+        self.store.fetch_open_orders.assert_called_once_with(SYMBOL)
+        self.assertEqual(order.status, Order.Completed)
+
+    def test_submit_uses_complete_create_order_response(self):
+        """
+        create_order already returns the order, it isn't fetched again.
+        """
+        order = self.buy()
+
+        self.store.fetch_order.assert_not_called()
+        self.assertEqual(order.ccxt_order['status'], 'open')
+
+    def test_submit_fetches_incomplete_create_order_response(self):
+        """
+        Exchanges which leave status, side or amount out of the create_order response get the order fetched.
+        """
+        for field in ('status', 'side', 'amount'):
+            self.store.create_order.side_effect = lambda *args, **kwargs: dict(
+                self.create_order(*args, **kwargs), **{field: None})
+            self.store.fetch_order.reset_mock()
+
+            order = self.buy()
+
+            self.store.fetch_order.assert_called_once_with(order.ccxt_order['id'], SYMBOL)
+            self.assertIsNotNone(order.ccxt_order[field])
+
+    def test_submit_fetch_after_create(self):
+        """
+        fetch_after_create forces fetching the order even for a complete create_order response.
+        """
+        self.broker.fetch_after_create = True
+
+        self.buy()
+
+        self.store.fetch_order.assert_called_once_with('0', SYMBOL)
+
+    def test_stop_market_keeps_given_stop_price(self):
+        """
+        The order price is only the default stopPrice of a STOP_MARKET order, a stopPrice passed in is kept.
+        """
+        self.buy(price=100.0, execType=Order.Stop, params={'stopPrice': 88})
+        self.assertEqual(self.store.create_order.call_args.kwargs['params']['stopPrice'], 88)
+
+        self.buy(price=100.0, execType=Order.Stop)
+        self.assertEqual(self.store.create_order.call_args.kwargs['params']['stopPrice'], 100.0)
+
+
+if __name__ == '__main__':
+    unittest.main()